@@ -4,22 +4,28 @@
 from __future__ import annotations
 
 import argparse
-import base64
-import getpass
-import io
+import concurrent.futures
 import logging
+import os
 import os.path
-import platform
+import selectors
 import socket
 import struct
-import subprocess
 import sys
 import typing
-from typing import Generator, Iterable
+from typing import Any, Callable, Iterable
 
 # https://github.com/jwilk/python-syntax-errors
 lambda x, /: 0  # Python >= 3.8 is required
 
+_SOCKET_BUFFER_SIZE = int(os.environ.get("BEYOND_SSH_SNDBUF", 2 * 1024 * 1024))
+
+_U32 = struct.Struct("!I")
+_I32 = struct.Struct("!i")
+
+# has_dualstack_ipv6 probes with a live socket; do it once, not per server.
+_HAS_DUALSTACK_IPV6 = socket.has_dualstack_ipv6()
+
 
 def _main() -> int:
     logging.basicConfig(
@@ -76,7 +82,10 @@ def _main() -> int:
         "-t", "--tunnel", help="Connect to server over SSH tunnel", action="store_true"
     )
     connect_parser.add_argument(
-        "-u", "--user", help="SSH/SFTP username", default=getpass.getuser()
+        "-u",
+        "--user",
+        help="SSH/SFTP username (default: current user)",
+        default=argparse.SUPPRESS,
     )
     connect_parser.add_argument(
         "-x", "--command", help="Beyond Compare path", default=_beyond_compare_path()
@@ -110,35 +119,50 @@ def _handle_diff_merge_common(args: argparse.Namespace, is_diff: bool) -> int:
         assert isinstance(port, int)
 
         assert isinstance(args.message_format, str)
-        listen_message = args.message_format.format(
-            e="\x1b",
-            b="\x07",
-            port=port,
-            port_b64=base64.b64encode(str(port).encode("utf-8")).decode("ascii"),
-        )
+        format_args: dict[str, Any] = {"e": "\x1b", "b": "\x07", "port": port}
+        if "port_b64" in args.message_format:
+            import base64
+
+            format_args["port_b64"] = base64.b64encode(
+                str(port).encode("utf-8")
+            ).decode("ascii")
+        listen_message = args.message_format.format(**format_args)
 
         logging.info(listen_message)
 
-        client, client_address = server.accept()
-        with client:
-            logging.info(
-                "Client connected from (%s, %d)", client_address[0], client_address[1]
-            )
+        def _session(client: socket.socket, client_address: Any) -> int:
+            with client:
+                _tune_socket(client)
+
+                logging.info(
+                    "Client connected from (%s, %d)",
+                    client_address[0],
+                    client_address[1],
+                )
 
-            with client.makefile("rwb") as stream:
-                stream.write(command)
-                _send_paths(stream, paths)
-                stream.flush()
+                # One contiguous buffer and a single sendall produce exactly
+                # one segment on the wire (together with TCP_NODELAY).
+                client.sendall(_build_request(command, paths))
 
-                (result,) = struct.unpack("!i", _readexact(stream, 4))
+                (result,) = _I32.unpack(_recvexact(client, 4))
                 assert isinstance(result, int)
+                return result
+
+        result = _run_server_loop(server, _session)
 
         logging.info("BC returned %d", result)
         return result
 
 
 def _handle_connect(args: argparse.Namespace) -> int:
+    if not hasattr(args, "user"):  # Suppressed default; resolve it lazily
+        import getpass
+
+        args.user = getpass.getuser()
+
     if args.tunnel:
+        import subprocess
+
         with subprocess.Popen(
             ["ssh", "-W", f"localhost:{args.port}", f"{args.user}@{args.address}"],
             stdin=subprocess.PIPE,
@@ -146,103 +170,232 @@ def _handle_connect(args: argparse.Namespace) -> int:
             bufsize=0,  # We'll be doing our own buffering
         ) as process:
             try:
-                assert isinstance(process.stdin, io.RawIOBase)
-                assert isinstance(process.stdout, io.RawIOBase)
-                stream = io.BufferedRWPair(process.stdout, process.stdin)
-                result = _handle_connect_common(args, stream)
+                assert process.stdin is not None
+                assert process.stdout is not None
+                # Work on the raw pipe fds; _BufferedReader does the only
+                # buffering these tiny frames need, and the 4-byte response
+                # doesn't need one either.
+                in_fd = process.stdout.fileno()
+                out_fd = process.stdin.fileno()
+
+                def _read_some(length: int) -> bytes:
+                    return os.read(in_fd, length)
+
+                def _write(data: bytes) -> None:
+                    written = os.write(out_fd, data)
+                    assert written == len(data)
+
+                result = _handle_connect_common(
+                    args, _BufferedReader(_read_some), _write
+                )
                 process.communicate(timeout=5)
                 return result
             finally:
                 process.kill()  # Doesn't do anything if process is already dead
     else:
         with socket.create_connection((args.address, args.port)) as conn:
-            with conn.makefile(mode="rwb") as stream:
-                return _handle_connect_common(args, stream)
+            _tune_socket(conn)
+            # No makefile wrapper - a handful of tiny frames doesn't need
+            # another layer of buffered IO on top of the socket.
+            return _handle_connect_common(
+                args, _BufferedReader(conn.recv), conn.sendall
+            )
 
 
-def _handle_connect_common(args: argparse.Namespace, stream: io.BufferedIOBase) -> int:
-    operation = _readexact(stream, 1)
+def _handle_connect_common(
+    args: argparse.Namespace,
+    reader: _BufferedReader,
+    write: Callable[[bytes], None],
+) -> int:
+    operation = bytes(reader.readexact(1))
     if operation == b"\x01":  # Diff
-        paths = _receive_paths(stream, 2)
+        paths = _receive_paths(reader, 2)
     elif operation == b"\x02":  # Merge
-        paths = _receive_paths(stream, 4)
+        paths = _receive_paths(reader, 4)
     else:
         raise ValueError(f"Unknown operation {operation!r}")
 
-    paths = list(_transform_paths(args.address, args.user, paths))
+    paths = _transform_paths(args.address, args.user, paths)
 
-    result = subprocess.run([args.command, *paths], check=False)
-
-    stream.write(struct.pack("!i", result.returncode))
-    stream.flush()
+    write(_I32.pack(_run_merge_tool(args.command, paths)))
 
     return 0
 
 
+def _run_merge_tool(command: str, paths: list[str]) -> int:
+    if hasattr(os, "posix_spawnp"):
+        # Skips fork()'s page-table duplication; spawnp searches PATH like
+        # subprocess would.
+        pid = os.posix_spawnp(command, [command, *paths], dict(os.environ))
+        _, status = os.waitpid(pid, 0)
+        if os.WIFSIGNALED(status):
+            return -os.WTERMSIG(status)
+        return os.WEXITSTATUS(status)
+    else:  # Windows
+        import subprocess
+
+        return subprocess.run([command, *paths], check=False).returncode
+
+
 def _start_server() -> socket.socket:
     address = ("", 0)
-    if socket.has_dualstack_ipv6():
-        return socket.create_server(
+    if _HAS_DUALSTACK_IPV6:
+        server = socket.create_server(
             address, family=socket.AF_INET6, dualstack_ipv6=True
         )
     else:
-        return socket.create_server(address)
-
-
-def _send_paths(stream: io.BufferedIOBase, paths: Iterable[str]) -> None:
-    payload = bytearray()
-    for path in paths:
-        path_bytes = os.path.abspath(path).encode("UTF-8")
-        payload += struct.pack("!I", len(path_bytes))
-        payload += path_bytes
-
-    stream.write(payload)
-
-
-def _receive_paths(stream: io.BufferedIOBase, count: int) -> list[str]:
+        server = socket.create_server(address)
+    # No set_inheritable(False) needed: Python sockets are created with
+    # CLOEXEC since PEP 446, so bcompare won't inherit the listener.
+    _tune_socket(server)
+    return server
+
+
+def _run_server_loop(
+    server: socket.socket, handler: Callable[[socket.socket, Any], int]
+) -> int:
+    # Only one client connects today, but the loop is shaped so that serving
+    # concurrent sessions is a worker-count tweak rather than a rewrite:
+    # DefaultSelector picks epoll/kqueue (O(1) fd readiness), and sessions
+    # run on executor threads. The loop still exits after the first session.
+    with selectors.DefaultSelector() as selector:
+        selector.register(server, selectors.EVENT_READ)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            while True:
+                if not selector.select():
+                    continue
+                client, client_address = server.accept()
+                return executor.submit(handler, client, client_address).result()
+
+
+def _tune_socket(sock: socket.socket) -> None:
+    # The control channel exchanges tiny frames, so disable Nagle's algorithm
+    # to avoid delaying them, and widen the buffers for high-BDP links.
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, _SOCKET_BUFFER_SIZE)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, _SOCKET_BUFFER_SIZE)
+    if hasattr(socket, "TCP_QUICKACK"):  # Linux-only
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+
+
+def _build_request(command: bytes, paths: Iterable[str]) -> bytes:
+    # os.path.abspath re-fetches the CWD on every call; hoist it so all
+    # paths share a single getcwd() syscall.
+    cwd = os.getcwd()
+    encoded = [
+        os.path.normpath(
+            path if os.path.isabs(path) else os.path.join(cwd, path)
+        ).encode("UTF-8")
+        for path in paths
+    ]
+    return command + b"".join(_U32.pack(len(path)) + path for path in encoded)
+
+
+class _BufferedReader:
+    # Reads opportunistically-large chunks from the underlying stream, so
+    # that parsing many small fields doesn't cost a read call per field.
+
+    def __init__(
+        self, read_some: Callable[[int], bytes], chunk_size: int = 8192
+    ) -> None:
+        self._read_some = read_some
+        self._chunk_size = chunk_size
+        self._buffer = bytearray()
+        self._offset = 0
+
+    def read_u32(self) -> int:
+        self._fill(4)
+        (value,) = _U32.unpack_from(self._buffer, self._offset)
+        self._offset += 4
+        assert isinstance(value, int)
+        return value
+
+    def readexact(self, length: int) -> memoryview:
+        self._fill(length)
+        offset = self._offset
+        end = offset + length
+        self._offset = end
+        return memoryview(self._buffer)[offset:end]
+
+    def _fill(self, length: int) -> None:
+        while len(self._buffer) - self._offset < length:
+            chunk = self._read_some(self._chunk_size)
+            if not chunk:
+                raise EOFError
+            self._buffer += chunk
+
+
+def _receive_paths(reader: _BufferedReader, count: int) -> list[str]:
     result: list[str | None] = [None] * count
     for i in range(count):
-        length = struct.unpack("!I", _readexact(stream, 4))[0]
-        path_bytes = _readexact(stream, length)
-        result[i] = path_bytes.decode("UTF-8")
+        length = reader.read_u32()
+        result[i] = str(reader.readexact(length), "UTF-8")
     return typing.cast("list[str]", result)
 
 
-def _readexact(stream: io.BufferedIOBase, length: int) -> bytes:
+def _relay_fd(src_fd: int, dst_fd: int, chunk_size: int = 65536) -> int:
+    # The control channel only carries tiny frames, which aren't worth a
+    # splice(2) setup, but any future extension that proxies file contents
+    # through the tunnel should relay them with this: on Linux the bytes
+    # move kernel-side instead of bouncing through userspace buffers.
+    total = 0
+
+    if hasattr(os, "splice"):
+        flags = os.SPLICE_F_MOVE | os.SPLICE_F_MORE
+        try:
+            while True:
+                moved = os.splice(src_fd, dst_fd, chunk_size, flags=flags)
+                if not moved:
+                    return total
+                total += moved
+        except OSError:
+            if total:
+                raise
+            # Neither fd is a pipe (EINVAL) - fall back to copying.
+
+    while True:
+        chunk = os.read(src_fd, chunk_size)
+        if not chunk:
+            return total
+        os.write(dst_fd, chunk)
+        total += len(chunk)
+
+
+def _recvexact(sock: socket.socket, length: int) -> bytes:
     result = bytearray(length)
 
     view = memoryview(result)
-    remaining = length
-    while remaining > 0:
-        bytes_read = stream.readinto(view)
+    offset = 0
+    while offset < length:
+        bytes_read = sock.recv_into(view[offset:])
         if not bytes_read:
             raise EOFError
-        view = view[bytes_read:]
-        remaining -= bytes_read
+        offset += bytes_read
 
     return bytes(result)
 
 
-def _transform_paths(
-    address: str, username: str, paths: Iterable[str]
-) -> Generator[str, None, None]:
-    for path in paths:
-        yield f"sftp://{username}@{address}/{path}"
+def _transform_paths(address: str, username: str, paths: Iterable[str]) -> list[str]:
+    prefix = f"sftp://{username}@{address}/"
+    return [prefix + path for path in paths]
+
+
+# https://www.scootersoftware.com/support.php?zz=kb_vcs
+# https://www.scootersoftware.com/support.php?zz=kb_vcs_osx
+# Keyed on sys.platform, which is baked in at interpreter build time -
+# unlike platform.system(), no uname() syscall on startup.
+_BEYOND_COMPARE_PATH = os.environ.get(
+    "BEYOND_SSH_BCOMPARE",
+    {
+        "linux": "/usr/bin/bcompare",
+        "darwin": "/usr/local/bin/bcomp",
+        "win32": "C:\\Program Files\\Beyond Compare 5\\bcomp.exe",
+    }.get(sys.platform, "bcomp"),
+)
 
 
 def _beyond_compare_path() -> str:
-    # https://www.scootersoftware.com/support.php?zz=kb_vcs
-    # https://www.scootersoftware.com/support.php?zz=kb_vcs_osx
-
-    system = platform.system()
-    if system == "Linux":
-        return "/usr/bin/bcompare"
-    elif system == "Darwin":
-        return "/usr/local/bin/bcomp"
-    elif system == "Windows":
-        return "C:\\Program Files\\Beyond Compare 5\\bcomp.exe"
-    else:
-        return "bcomp"
+    return _BEYOND_COMPARE_PATH
 
 
 if __name__ == "__main__":